@@ -2,10 +2,16 @@ import os
 import asyncio
 import logging
 import re
-from datetime import datetime
-import pytz
-import requests
+import time
+from collections import Counter
+from datetime import datetime, time as dtime
+from zoneinfo import ZoneInfo
+import aiohttp
+import aiosqlite
+import orjson
+from aiolimiter import AsyncLimiter
 from telegram import Update, ReplyKeyboardMarkup
+from telegram.error import Forbidden, RetryAfter, TelegramError
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, ContextTypes, filters,
 )
@@ -16,6 +22,7 @@ logger = logging.getLogger(__name__)
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Например: https://your-app.onrender.com/webhook
 PORT = int(os.getenv("PORT", 8443))
+DB_PATH = os.getenv("DB_PATH", "bot.db")
 
 HH_API_URL = "https://api.hh.ru/vacancies"
 HH_SEARCH_PARAMS = {
@@ -26,91 +33,305 @@ HH_SEARCH_PARAMS = {
     "experience": "noExperience",
 }
 VACANCY_LIMIT = 2000
+HH_CONCURRENCY = 5
+CACHE_TTL = 300
+MESSAGE_LIMIT = 3900  # запас до лимита Telegram в 4096 символов
+KEEP_DAYS = 7  # сколько дней хранить отправленные id и сводки
+_EMPTY = {}  # общая заглушка для отсутствующих вложенных объектов HH
 
-user_daily_vacancies = {}
-user_sent_vacancies = {}
-
-def get_vacancies():
-    vacancies = []
-    page = 0
-    msk_tz = pytz.timezone("Europe/Moscow")
-    now = datetime.now(msk_tz)
-    HH_SEARCH_PARAMS.update({
-        "date_from": now.replace(hour=0, minute=0, second=0, microsecond=0).isoformat(),
-        "date_to": now.replace(hour=23, minute=59, second=59, microsecond=0).isoformat(),
-    })
-    while True:
-        HH_SEARCH_PARAMS["page"] = page
-        logger.info(f"Fetching vacancies, page {page}")
-        try:
-            r = requests.get(HH_API_URL, params=HH_SEARCH_PARAMS, timeout=30)
+MSK_TZ = ZoneInfo("Europe/Moscow")
+
+HTTP = None  # aiohttp.ClientSession, создаётся в on_startup
+DB = None  # aiosqlite.Connection, открывается в on_startup
+subscribers = set()  # chat_id, получающие вакансии; копия таблицы subscribers
+
+POLL_INTERVAL = 600
+
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS subscribers (
+    chat_id INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS sent (
+    chat_id INTEGER NOT NULL,
+    vid TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, vid)
+);
+CREATE INDEX IF NOT EXISTS sent_ts ON sent (ts);
+CREATE TABLE IF NOT EXISTS daily (
+    chat_id INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    company TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, day, company)
+);
+"""
+
+# Общий для всех пользователей кэш выдачи HH на CACHE_TTL секунд:
+# список (id, компания, готовый текст сообщения)
+_cache = {"ts": 0.0, "data": []}
+_cache_lock = asyncio.Lock()
+
+# Границы текущих суток по Москве для date_from/date_to, пересчитываются раз в день
+_date_cache = {"date": None, "from": "", "to": ""}
+
+# ETag и разобранный ответ последней загрузки каждой страницы HH
+_pages = {}
+
+# Лимиты Telegram: ~30 сообщений/с на бота и 1 сообщение/с в один чат
+global_limiter = AsyncLimiter(28, 1)
+chat_limiters = {}
+
+async def fetch_page(sem, base_params, page):
+    params = {**base_params, "page": page}
+    cached = _pages.get(page)
+    headers = {"If-None-Match": cached[0]} if cached else None
+    logger.info(f"Fetching vacancies, page {page}")
+    try:
+        async with sem, HTTP.get(HH_API_URL, params=params, headers=headers, timeout=30) as r:
+            if r.status == 304:
+                return cached[1]
             r.raise_for_status()
-        except Exception as e:
-            logger.error(f"Request error: {e}")
-            break
-        items = r.json().get("items", [])
-        vacancies.extend(items)
-        if len(items) < 99 or len(vacancies) >= VACANCY_LIMIT:
-            break
-        page += 1
-    return vacancies[:VACANCY_LIMIT]
+            data = orjson.loads(await r.read())
+            etag = r.headers.get("ETag")
+            if etag:
+                _pages[page] = (etag, data)
+            else:
+                _pages.pop(page, None)
+            return data
+    except Exception as e:
+        logger.error(f"Request error (page {page}): {e}")
+        return {}
+
+def date_range():
+    now = datetime.now(MSK_TZ)
+    if _date_cache["date"] != now.date():
+        _date_cache.update({
+            "date": now.date(),
+            "from": now.replace(hour=0, minute=0, second=0, microsecond=0).isoformat(),
+            "to": now.replace(hour=23, minute=59, second=59, microsecond=0).isoformat(),
+        })
+    return _date_cache["from"], _date_cache["to"]
+
+async def fetch_vacancies():
+    date_from, date_to = date_range()
+    base_params = {**HH_SEARCH_PARAMS, "date_from": date_from, "date_to": date_to}
+    sem = asyncio.Semaphore(HH_CONCURRENCY)
+    first = await fetch_page(sem, base_params, 0)
+    vacancies = list(first.get("items", []))
+    per_page = base_params["per_page"]
+    pages = min(first.get("pages", 1), -(-VACANCY_LIMIT // per_page))
+    results = await asyncio.gather(*(fetch_page(sem, base_params, p) for p in range(1, pages)))
+    for data in results:
+        vacancies.extend(data.get("items", []))
+    # Крупные работодатели публикуют одну и ту же вакансию много раз
+    seen = set()
+    unique = []
+    for v in vacancies:
+        key = (
+            v.get('name'),
+            (v.get('employer') or _EMPTY).get('id'),
+            (v.get('area') or _EMPTY).get('id'),
+        )
+        if key in seen:
+            continue
+        seen.add(key)
+        unique.append(v)
+    return unique[:VACANCY_LIMIT]
+
+async def get_vacancies():
+    async with _cache_lock:
+        if time.time() - _cache["ts"] < CACHE_TTL:
+            return _cache["data"]
+        data = []
+        for v in await fetch_vacancies():
+            company = employer_name(v)
+            data.append((v['id'], company, format_vacancy(v, company)))
+        _cache["data"] = data
+        _cache["ts"] = time.time()
+        return _cache["data"]
+
+_HL_OPEN = "<highlighttext>"
+_HL_CLOSE = "</highlighttext>"
+_TAG_RE = re.compile(r"<[^>]*>")
 
 def clean_text(text):
-    return re.sub(r"<[^>]*>", "", text).strip() if text else ''
-
-def format_vacancy(vac):
-    name = vac.get('name', 'Не указано')
-    salary = vac.get('salary') or {}
-    salary_from = salary.get('from', 'Не указана')
-    salary_to = salary.get('to', 'Не указана')
-    area = vac.get('area', {}).get('name', 'Не указан')
-    employer = vac.get('employer', {}).get('name', 'Не указана')
-    schedule = vac.get('schedule', {}).get('name', 'Не указано')
-    desc = clean_text(vac.get('snippet', {}).get('responsibility', 'Описание отсутствует.'))
-    return (
-        f"🔹 *{name}*\n"
-        f"💼 Компания: {employer}\n"
-        f"💰 Зарплата: от {salary_from} до {salary_to} руб.\n"
-        f"📍 Город: {area}\n"
-        f"🕒 Формат работы: {schedule}\n"
-        f"✍️ Описание:\n{desc}\n"
-        f"🔗 [Подробнее]({vac.get('alternate_url', '#' )})"
+    if not text:
+        return ''
+    text = text.replace(_HL_OPEN, "").replace(_HL_CLOSE, "")
+    if "<" in text:
+        text = _TAG_RE.sub("", text)
+    return text.strip()
+
+_TEMPLATE = (
+    "🔹 *{name}*\n"
+    "💼 Компания: {employer}\n"
+    "💰 Зарплата: от {salary_from} до {salary_to} руб.\n"
+    "📍 Город: {area}\n"
+    "🕒 Формат работы: {schedule}\n"
+    "✍️ Описание:\n{desc}\n"
+    "🔗 [Подробнее]({url})"
+)
+
+def employer_name(vac):
+    return (vac.get('employer') or _EMPTY).get('name') or 'Не указана'
+
+def format_vacancy(vac, employer):
+    salary = vac.get('salary') or _EMPTY
+    snippet = vac.get('snippet') or _EMPTY
+    return _TEMPLATE.format_map({
+        "name": vac.get('name') or 'Не указано',
+        "employer": employer,
+        "salary_from": salary.get('from') or 'Не указана',
+        "salary_to": salary.get('to') or 'Не указана',
+        "area": (vac.get('area') or _EMPTY).get('name') or 'Не указан',
+        "schedule": (vac.get('schedule') or _EMPTY).get('name') or 'Не указано',
+        "desc": clean_text(snippet.get('responsibility')) or 'Описание отсутствует.',
+        "url": vac.get('alternate_url') or '#',
+    })
+
+def today():
+    return datetime.now(MSK_TZ).date().isoformat()
+
+async def init_db():
+    global DB
+    DB = await aiosqlite.connect(DB_PATH)
+    await DB.execute("PRAGMA journal_mode=WAL")
+    await DB.executescript(DB_SCHEMA)
+    await DB.commit()
+    async with DB.execute("SELECT chat_id FROM subscribers") as cur:
+        subscribers.update(chat_id for chat_id, in await cur.fetchall())
+
+async def add_subscriber(chat_id):
+    """Подписывает чат и возвращает True, если его ещё не было среди подписчиков."""
+    if chat_id in subscribers:
+        return False
+    subscribers.add(chat_id)
+    await DB.execute("INSERT OR IGNORE INTO subscribers (chat_id) VALUES (?)", (chat_id,))
+    await DB.commit()
+    return True
+
+async def remove_subscriber(chat_id):
+    subscribers.discard(chat_id)
+    chat_limiters.pop(chat_id, None)
+    await DB.execute("DELETE FROM subscribers WHERE chat_id = ?", (chat_id,))
+    await DB.commit()
+
+async def mark_sent(chat_id, vacancy_ids):
+    """Запоминает id как отправленные и возвращает те, которых ещё не было."""
+    async with DB.execute(
+        "INSERT OR IGNORE INTO sent (chat_id, vid, ts) "
+        "SELECT ?, value, ? FROM json_each(?) RETURNING vid",
+        (chat_id, int(time.time()), orjson.dumps(vacancy_ids).decode()),
+    ) as cur:
+        rows = await cur.fetchall()
+    await DB.commit()
+    return {vid for vid, in rows}
+
+async def add_daily(chat_id, counts):
+    day = today()
+    await DB.executemany(
+        "INSERT INTO daily (chat_id, day, company, count) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (chat_id, day, company) DO UPDATE SET count = count + excluded.count",
+        [(chat_id, day, company, count) for company, count in counts.items()],
     )
+    await DB.commit()
+
+async def get_daily(chat_id):
+    async with DB.execute(
+        "SELECT company, count FROM daily WHERE chat_id = ? AND day = ? ORDER BY count DESC",
+        (chat_id, today()),
+    ) as cur:
+        return await cur.fetchall()
+
+async def cleanup_db(context: ContextTypes.DEFAULT_TYPE):
+    cutoff = int(time.time()) - KEEP_DAYS * 86400
+    await DB.execute("DELETE FROM sent WHERE ts < ?", (cutoff,))
+    await DB.execute(
+        "DELETE FROM daily WHERE day < ?",
+        (datetime.fromtimestamp(cutoff, MSK_TZ).date().isoformat(),),
+    )
+    await DB.commit()
+    logger.info("Old sent/daily rows removed")
+
+def split_long(text, limit=MESSAGE_LIMIT):
+    """Режет текст длиннее limit на куски, по возможности по переводу строки."""
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        yield text[:cut]
+        text = text[cut:].lstrip("\n")
+    if text:
+        yield text
+
+def pack_messages(parts, limit=MESSAGE_LIMIT, sep=""):
+    chunk, length = [], 0
+    for part in (piece for p in parts for piece in split_long(p, limit)):
+        extra = len(part) + (len(sep) if chunk else 0)
+        if chunk and length + extra > limit:
+            yield sep.join(chunk)
+            chunk, length = [], 0
+            extra = len(part)
+        chunk.append(part)
+        length += extra
+    if chunk:
+        yield sep.join(chunk)
+
+def get_chat_limiter(chat_id):
+    if chat_id not in chat_limiters:
+        chat_limiters[chat_id] = AsyncLimiter(1, 1)
+    return chat_limiters[chat_id]
 
 async def send_message_with_retry(context, chat_id, message):
+    chat_limiter = get_chat_limiter(chat_id)
     while True:
         try:
-            await context.bot.send_message(chat_id, message, parse_mode="Markdown")
+            async with chat_limiter, global_limiter:
+                await context.bot.send_message(chat_id, message, parse_mode="Markdown")
             break
-        except Exception as e:
-            err = str(e)
-            if "Flood control exceeded" in err:
-                retry_after = int(err.split("Retry in")[1].strip().split()[0])
-                logger.warning(f"Flood control: wait {retry_after}s")
-                await asyncio.sleep(retry_after + 1)
-            else:
-                logger.error(f"Send message error: {e}")
+        except RetryAfter as e:
+            logger.warning(f"Flood control: wait {e.retry_after}s")
+            await asyncio.sleep(e.retry_after + 1)
+        except Forbidden as e:
+            # Бот заблокирован или удалён из чата: больше туда не пишем
+            logger.warning(f"Chat {chat_id} unavailable, unsubscribing: {e}")
+            await remove_subscriber(chat_id)
+            break
+        except TelegramError as e:
+            logger.error(f"Send message error: {e}")
+            break
+
+async def deliver(context, chat_id, vacancies):
+    try:
+        new_ids = await mark_sent(chat_id, [vacancy_id for vacancy_id, _, _ in vacancies])
+        unique = [v for v in vacancies if v[0] in new_ids]
+        await add_daily(chat_id, Counter(company for _, company, _ in unique))
+        for msg in pack_messages((text for _, _, text in unique), sep="\n\n"):
+            await send_message_with_retry(context, chat_id, msg)
+            if chat_id not in subscribers:
                 break
+    except Exception as e:
+        logger.error(f"Error delivering vacancies to {chat_id}: {e}")
 
 async def send_vacancies(context: ContextTypes.DEFAULT_TYPE):
-    chat_id = context.job.chat_id
-    if chat_id not in user_sent_vacancies:
-        user_sent_vacancies[chat_id] = set()
-        user_daily_vacancies[chat_id] = {}
+    if not subscribers:
+        return
     try:
-        vacancies = get_vacancies()
-        unique = [v for v in vacancies if v['id'] not in user_sent_vacancies[chat_id]]
-        for v in unique:
-            user_sent_vacancies[chat_id].add(v['id'])
-            company = v.get('employer', {}).get('name', 'Не указано')
-            user_daily_vacancies[chat_id][company] = user_daily_vacancies[chat_id].get(company, 0) + 1
-        for i in range(0, len(unique), 5):
-            batch = unique[i:i+5]
-            msg = "\n\n".join(format_vacancy(v) for v in batch)
-            await send_message_with_retry(context, chat_id, msg)
-            await asyncio.sleep(2)
+        vacancies = await get_vacancies()
     except Exception as e:
         logger.error(f"Error processing vacancies: {e}")
+        return
+    await asyncio.gather(*(deliver(context, chat_id, vacancies) for chat_id in list(subscribers)))
+
+async def send_first_vacancies(context: ContextTypes.DEFAULT_TYPE):
+    # Новый подписчик получает вакансии сразу, не дожидаясь общего тика
+    try:
+        vacancies = await get_vacancies()
+    except Exception as e:
+        logger.error(f"Error processing vacancies: {e}")
+        return
+    await deliver(context, context.job.chat_id, vacancies)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
@@ -120,35 +341,43 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Нажмите на кнопку ниже, чтобы получить ежедневную сводку.",
         reply_markup=reply_markup
     )
-    context.job_queue.run_repeating(send_vacancies, interval=600, first=10, chat_id=chat_id)
+    if await add_subscriber(chat_id):
+        context.job_queue.run_once(send_first_vacancies, when=10, chat_id=chat_id)
 
 async def daily_summary_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    if chat_id not in user_daily_vacancies:
-        user_daily_vacancies[chat_id] = {}
-    summary = "📊 *Ежедневная сводка по компаниям:*\n\n"
-    sorted_data = sorted(user_daily_vacancies[chat_id].items(), key=lambda x: x[1], reverse=True)
-    if not sorted_data:
-        summary += "Сегодня вакансий не было."
+    parts = ["📊 *Ежедневная сводка по компаниям:*\n\n"]
+    counts = await get_daily(chat_id)
+    if not counts:
+        parts.append("Сегодня вакансий не было.")
     else:
-        for company, count in sorted_data:
-            summary += f"🏢 {company}: {count} вакансий\n"
-    chunk_size = 4000
-    for i in range(0, len(summary), chunk_size):
-        await context.bot.send_message(chat_id, summary[i:i+chunk_size], parse_mode="Markdown")
+        parts.extend(f"🏢 {company}: {count} вакансий\n" for company, count in counts)
+    for chunk in pack_messages(parts):
+        await send_message_with_retry(context, chat_id, chunk)
 
 async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.text == "📊 Ежедневная сводка":
         await daily_summary_command(update, context)
 
 async def on_startup(application: Application):
+    global HTTP
+    HTTP = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=20, keepalive_timeout=60))
+    await init_db()
     await application.bot.set_webhook(WEBHOOK_URL)
     logger.info(f"Webhook set: {WEBHOOK_URL}")
 
+async def on_shutdown(application: Application):
+    if HTTP is not None:
+        await HTTP.close()
+    if DB is not None:
+        await DB.close()
+
 async def run_bot():
     app = Application.builder().token(TELEGRAM_TOKEN).build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_button))
+    app.job_queue.run_repeating(send_vacancies, interval=POLL_INTERVAL, first=10)
+    app.job_queue.run_daily(cleanup_db, time=dtime(hour=3, minute=5, tzinfo=MSK_TZ))
 
     logger.info(f"Webhook URL: {WEBHOOK_URL}")
 
@@ -161,7 +390,13 @@ async def run_bot():
         webhook_url=WEBHOOK_URL
     )
 
-    await asyncio.Event().wait()  # Не завершать приложение
+    try:
+        await asyncio.Event().wait()  # Не завершать приложение
+    finally:
+        await app.updater.stop()
+        await app.stop()
+        await on_shutdown(app)
+        await app.shutdown()
 
 if __name__ == "__main__":
     asyncio.run(run_bot())